@@ -5,113 +5,334 @@ Uses PyMuPDF (fitz) to insert artwork into PDF template layers
 Preserves OCG (Optional Content Groups) structure
 """
 
+import os
+import re
 import sys
-import fitz  # PyMuPDF
-import json
+from functools import lru_cache
 
-def find_ocg_by_name(doc, name):
-    """Find an OCG (Optional Content Group) by name, return first match"""
+# fitz (PyMuPDF) and json are imported lazily where first needed: the
+# fitz C extension alone costs ~100 ms to load, which usage errors and
+# bad argv exits should not pay.
+
+# Verbose per-step logging (OCG dumps, progress messages) is only useful
+# when debugging a template; keep it off the hot path by default.
+DEBUG = bool(os.environ.get("PRINTPILOT_DEBUG"))
+
+_log_lines = []
+
+def _log(msg):
+    """Queue a progress message, no-op unless PRINTPILOT_DEBUG is set
+
+    stderr is unbuffered, so printing each line costs a write syscall;
+    lines are collected here and emitted in one call per job by
+    _flush_log().
+    """
+    if DEBUG:
+        _log_lines.append(msg)
+
+def _flush_log():
+    """Write any queued log lines to stderr in a single call"""
+    if _log_lines:
+        sys.stderr.write("\n".join(_log_lines) + "\n")
+        del _log_lines[:]
+
+@lru_cache(maxsize=32)
+def _template_bytes(path, mtime):
+    """Read a template file, cached on (path, mtime)
+
+    The same blank template serves thousands of orders; in the
+    long-lived --serve and --batch workers every order after the first
+    gets the bytes from memory instead of disk. mtime is part of the key
+    so an updated template invalidates its cache entry.
+    """
+    with open(path, 'rb') as f:
+        return f.read()
+
+@lru_cache(maxsize=32)
+def _artwork_bytes(path, mtime):
+    """Read an artwork file, cached on (path, mtime)
+
+    Batch runs often place the same artwork on several product variants;
+    caching the encoded bytes (rather than a decoded Pixmap, which would
+    transcode JPEG artwork back to raw samples) lets insert_image ingest
+    the original stream every time without re-reading or re-decoding the
+    file.
+    """
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _ocg_name_map(oc_info):
+    """Build the uppercase-name -> xref lookup map from a get_ocgs() dict
+
+    Each OCG name is uppercased exactly once per document here; the
+    three layer lookups then work on pre-normalized keys.
+    """
+    return {ocg.get('name', '').upper(): xref for xref, ocg in oc_info.items()}
+
+def _ocg_name_map_lowlevel(doc):
+    """Build the name map straight from /Root/OCProperties/OCGs
+
+    get_ocgs() materializes a full per-OCG dict (visibility state,
+    usage, config hierarchy) that the layer lookup never reads - only
+    the names matter. Walk the OCG array with the low-level xref
+    accessors instead, one key read per OCG. Returns None when the
+    structure is missing or looks unexpected so the caller can fall
+    back to get_ocgs().
+    """
     try:
-        oc_info = doc.get_ocgs()
-        if oc_info:
-            for xref, ocg in oc_info.items():
-                ocg_name = ocg.get('name', '').upper()
-                if name.upper() in ocg_name or ocg_name in name.upper():
-                    return xref
-    except Exception as e:
-        print(f"Error finding OCG: {e}", file=sys.stderr)
+        kind, val = doc.xref_get_key(doc.pdf_catalog(), "OCProperties/OCGs")
+        if kind != 'array':
+            return None
+        name_map = {}
+        for xref in re.findall(r'(\d+)\s+\d+\s+R', val):
+            kind, name = doc.xref_get_key(int(xref), "Name")
+            if kind == 'string':
+                name_map[name.upper()] = int(xref)
+        return name_map
+    except Exception:
+        return None
+
+def find_ocg_by_name(name_map, name):
+    """Find an OCG (Optional Content Group) by name in a pre-built
+    uppercase-name -> xref map, return first match"""
+    target = name.upper()
+    xref = name_map.get(target)
+    if xref is not None:
+        return xref
+    # Fall back to the old substring matching ("ARTWORK" should still
+    # find a layer called "ARTWORK HERE")
+    for ocg_name, xref in name_map.items():
+        if target in ocg_name or ocg_name in target:
+            return xref
     return None
 
-def list_ocgs(doc):
-    """List all OCGs in the document"""
-    try:
-        oc_info = doc.get_ocgs()
-        if oc_info:
-            print(f"Found {len(oc_info)} OCG(s):", file=sys.stderr)
-            for xref, ocg in oc_info.items():
-                print(f"  xref={xref}: {ocg.get('name', 'unnamed')}", file=sys.stderr)
-            return oc_info
-        else:
-            print("No OCGs found in document", file=sys.stderr)
-    except Exception as e:
-        print(f"Error listing OCGs: {e}", file=sys.stderr)
-    return {}
+def list_ocgs(oc_info):
+    """List all OCGs from a pre-fetched doc.get_ocgs() dict"""
+    if oc_info:
+        _log(f"Found {len(oc_info)} OCG(s):")
+        for xref, ocg in oc_info.items():
+            _log(f"  xref={xref}: {ocg.get('name', 'unnamed')}")
+    else:
+        _log("No OCGs found in document")
 
-def process_pdf(template_path, artwork_path, output_path, layer_name="ARTWORK HERE"):
-    """
-    Insert artwork image into the specified layer of the template PDF
+def _deflate_opts(artwork_bytes):
+    """Choose save-time deflate kwargs from the artwork encoding
+
+    PNG (FlateDecode) and JPEG (DCTDecode) payloads are already
+    compressed - a second zlib pass burns CPU and can even grow the
+    stream - but anything else (BMP, raw pixel data) still benefits, so
+    only skip the image pass when the magic bytes say it is safe.
     """
-    print(f"Opening template: {template_path}", file=sys.stderr)
-    doc = fitz.open(template_path)
+    already_compressed = artwork_bytes[:2] in (b'\xff\xd8', b'\x89P')
+    return {
+        'deflate': True,
+        'deflate_images': not already_compressed,
+        'deflate_fonts': False,
+    }
 
-    # List existing OCGs
-    ocgs = list_ocgs(doc)
+def _insert_artwork(doc, artwork_bytes, layer_name):
+    """Insert the artwork image into an open document's target OCG layer"""
+    # Build the layer lookup map once. The low-level walk reads just the
+    # OCG names; the full get_ocgs() dict is only built when it is
+    # actually wanted (debug dump) or the cheap path bails out.
+    if DEBUG:
+        oc_info = doc.get_ocgs() or {}
+        list_ocgs(oc_info)
+        name_map = _ocg_name_map(oc_info)
+    else:
+        name_map = _ocg_name_map_lowlevel(doc)
+        if name_map is None:
+            name_map = _ocg_name_map(doc.get_ocgs() or {})
 
     # Get first page
     page = doc[0]
     page_rect = page.rect
-    print(f"Page size: {page_rect.width} x {page_rect.height} points", file=sys.stderr)
+    _log(f"Page size: {page_rect.width} x {page_rect.height} points")
 
     # Find the target OCG - "ARTWORK HERE"
-    artwork_ocg = find_ocg_by_name(doc, "ARTWORK")
-    template_ocg = find_ocg_by_name(doc, "TEMPLATE MASK")
-    background_ocg = find_ocg_by_name(doc, "BACKGROUND")
+    artwork_ocg = find_ocg_by_name(name_map, "ARTWORK")
+    template_ocg = find_ocg_by_name(name_map, "TEMPLATE MASK")
+    background_ocg = find_ocg_by_name(name_map, "BACKGROUND")
 
-    print(f"Found layers - ARTWORK: {artwork_ocg}, TEMPLATE: {template_ocg}, BACKGROUND: {background_ocg}", file=sys.stderr)
+    _log(f"Found layers - ARTWORK: {artwork_ocg}, TEMPLATE: {template_ocg}, BACKGROUND: {background_ocg}")
 
     if artwork_ocg:
-        print(f"Using existing ARTWORK layer xref={artwork_ocg}", file=sys.stderr)
+        _log(f"Using existing ARTWORK layer xref={artwork_ocg}")
         target_ocg = artwork_ocg
     else:
-        print(f"ARTWORK layer not found, creating new one", file=sys.stderr)
+        _log(f"ARTWORK layer not found, creating new one")
         target_ocg = doc.add_ocg(layer_name, on=True, intent="Design", usage="Artwork")
 
-    # Insert the artwork image with OCG association
-    print(f"Inserting artwork: {artwork_path}", file=sys.stderr)
+    # Insert the image, then attach the OCG by writing the /OC entry of
+    # the image XObject directly. The oc= keyword (and set_oc) go
+    # through the wrapper's dict re-serialization of the XObject; for a
+    # single known key, xref_set_key is one low-level call.
+    img_xref = page.insert_image(
+        page_rect,
+        stream=artwork_bytes,
+        overlay=False,  # Below existing content
+        keep_proportion=False
+    )
+    if img_xref and target_ocg:
+        doc.xref_set_key(img_xref, "OC", f"{target_ocg} 0 R")
+    _log(f"Image inserted with xref={img_xref}, OCG layer xref={target_ocg}")
+
+    # Verify OCGs after modification (debug only - forces another
+    # OCProperties traversal)
+    if DEBUG:
+        _log("\nFinal OCG structure:")
+        list_ocgs(doc.get_ocgs() or {})
+
+def process_pdf(template_path, artwork_path, output_path, layer_name="ARTWORK HERE"):
+    """
+    Insert artwork image into the specified layer of the template PDF
+    """
+    import fitz  # PyMuPDF
 
     try:
-        # Insert image and get its xref
-        # overlay=False puts it UNDER existing content
-        img_xref = page.insert_image(
-            page_rect,
-            filename=artwork_path,
-            overlay=False,  # Below existing content
-            keep_proportion=False
+        # Work on a copy of the template so the save can be incremental:
+        # only the inserted image (and OCG delta) gets appended, instead
+        # of re-serializing every unchanged template object. The copy is
+        # written from the cached template bytes in a single call.
+        _log(f"Opening template: {template_path}")
+        with open(output_path, 'wb') as f:
+            f.write(_template_bytes(template_path, os.path.getmtime(template_path)))
+        doc = fitz.open(output_path)
+
+        # Hand MuPDF the artwork as a memory stream rather than a
+        # filename, so it skips its own stat/open/mmap of the file; the
+        # bytes themselves are cached across repeated variants.
+        _log(f"Inserting artwork: {artwork_path}")
+        artwork_bytes = _artwork_bytes(artwork_path, os.path.getmtime(artwork_path))
+
+        _insert_artwork(doc, artwork_bytes, layer_name)
+
+        # Save - preserve structure. The incremental save appends only
+        # the new/changed objects to the copied template (incremental
+        # mode excludes garbage collection, which has nothing to reclaim
+        # here anyway since we only add objects). Deflate choices depend
+        # on how the artwork is encoded; template fonts are already
+        # subset.
+        _log(f"Saving to: {output_path}")
+        doc.save(output_path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP,
+                 **_deflate_opts(artwork_bytes))
+        doc.close()
+
+        _log("PDF processing complete!")
+        return True
+    finally:
+        _flush_log()
+
+def process_pdf_bytes(template_path, artwork_path, layer_name="ARTWORK HERE"):
+    """
+    Like process_pdf, but return the finished PDF as bytes
+
+    For consumers that ship the result over the network (object-store
+    upload, HTTP response) this skips the local filesystem round-trip
+    entirely: the template is opened from the cached in-memory buffer
+    and the result never touches disk.
+    """
+    import fitz  # PyMuPDF
+
+    try:
+        _log(f"Opening template: {template_path}")
+        doc = fitz.open(
+            stream=_template_bytes(template_path, os.path.getmtime(template_path)),
+            filetype="pdf",
         )
-        print(f"Image inserted with xref={img_xref}", file=sys.stderr)
 
-        # Associate the image with the ARTWORK OCG layer
-        if img_xref and target_ocg:
-            doc.set_oc(img_xref, target_ocg)
-            print(f"Image associated with OCG layer xref={target_ocg}", file=sys.stderr)
+        _log(f"Inserting artwork: {artwork_path}")
+        artwork_bytes = _artwork_bytes(artwork_path, os.path.getmtime(artwork_path))
+
+        _insert_artwork(doc, artwork_bytes, layer_name)
 
+        # A memory-backed document cannot be saved incrementally, so
+        # this is a full serialization - same deflate choices as
+        # process_pdf. clean=False: we never edit content streams, so
+        # MuPDF's stream sanitizer would re-lex every page's commands
+        # for nothing.
+        _log("Serializing to memory")
+        pdf_bytes = doc.tobytes(garbage=1, clean=False, **_deflate_opts(artwork_bytes))
+        doc.close()
+
+        _log("PDF processing complete!")
+        return pdf_bytes
+    finally:
+        _flush_log()
+
+def _run_job(job):
+    """Run one job dict, return a JSON-serializable result
+
+    Jobs with an "output" path are written to disk; jobs without one get
+    the finished PDF back inline as base64 in the "pdf" field, for
+    callers that upload the result directly.
+    """
+    try:
+        layer_name = job.get("layer_name", "ARTWORK HERE")
+        if "output" in job:
+            process_pdf(job["template"], job["artwork"], job["output"], layer_name)
+            return {"success": True, "output": job["output"]}
+        import base64
+        pdf_bytes = process_pdf_bytes(job["template"], job["artwork"], layer_name)
+        return {"success": True, "pdf": base64.b64encode(pdf_bytes).decode("ascii")}
     except Exception as e:
-        print(f"Error inserting image: {e}", file=sys.stderr)
-        # Try alternative method
-        print("Trying alternative insertion method...", file=sys.stderr)
-        page.insert_image(
-            page_rect,
-            filename=artwork_path,
-            overlay=False,
-            keep_proportion=False,
-            oc=target_ocg  # Direct OCG parameter
-        )
+        return {"success": False, "error": str(e), "output": job.get("output")}
 
-    # Verify OCGs after modification
-    print("\nFinal OCG structure:", file=sys.stderr)
-    list_ocgs(doc)
+def process_batch(jobs):
+    """
+    Process a list of job dicts in parallel, one worker per core
 
-    # Save - preserve structure
-    print(f"Saving to: {output_path}", file=sys.stderr)
-    doc.save(output_path, garbage=0, deflate=True, clean=False)
-    doc.close()
+    Each job needs "template", "artwork" and "output" paths plus an
+    optional "layer_name". A single interpreter launch (and fitz import)
+    is amortized across the whole batch instead of paid per order.
+    """
+    import multiprocessing
+    with multiprocessing.Pool(os.cpu_count()) as pool:
+        return pool.map(_run_job, jobs)
 
-    print("PDF processing complete!", file=sys.stderr)
-    return True
+def serve():
+    """
+    Long-lived worker loop for the Node front-end
+
+    Reads one JSON job dict per stdin line (same keys as batch jobs) and
+    writes one JSON result per stdout line. The front-end keeps the
+    subprocess pinned and pipes jobs into it instead of spawning a fresh
+    interpreter - and re-importing fitz - per request.
+    """
+    import json
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            result = _run_job(json.loads(line))
+        except Exception as e:
+            result = {"success": False, "error": str(e)}
+        sys.stdout.write(json.dumps(result) + "\n")
+        sys.stdout.flush()
 
 def main():
+    import json
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+        serve()
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        # Job list is a JSON array, read from a file argument or stdin
+        if len(sys.argv) > 2:
+            with open(sys.argv[2]) as f:
+                jobs = json.load(f)
+        else:
+            jobs = json.load(sys.stdin)
+        results = process_batch(jobs)
+        print(json.dumps(results))
+        sys.exit(0 if all(r["success"] for r in results) else 1)
+
     if len(sys.argv) < 4:
         print("Usage: python pdf_processor.py <template.pdf> <artwork.png> <output.pdf> [layer_name]", file=sys.stderr)
+        print("       python pdf_processor.py --batch [jobs.json]  (JSON job array, stdin if omitted)", file=sys.stderr)
+        print("       python pdf_processor.py --serve  (one JSON job per stdin line)", file=sys.stderr)
         sys.exit(1)
 
     template_path = sys.argv[1]